@@ -1,201 +1,450 @@
-from datetime import date
+from datetime import date, datetime
+import asyncio
 import tornado.escape
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import json
-from datetime import timedelta
+import time
 from multiprocessing import Manager
 from .version import __version__
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class VersionHandler(tornado.web.RequestHandler):
-    def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", "*")
-        self.set_header("Access-Control-Allow-Headers", "DNT,User-Agent,X-Requested-With,If-Modified-Since,Cache-Control,Content-Type,Range")
-        self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+#retcodes are stored as returned by salt, either as int or as str
+ok_retcodes = (0, '0')
+#seconds a websocket client may leave queued updates unsent before it is disconnected
+ws_max_lag = 10
+#longest wait between websocket updates, and how long a change is left to settle before it is sent
+ws_interval = 2
+ws_coalesce = 0.1
+#longest pause between retries while updates keep failing
+ws_max_backoff = 60
 
-    def get(self):
-        response = { 'version': '3.5.1',
-                     'last_build':  date.today().isoformat() }
-        self.write(response)
+def json_default(obj):
+    #orjson encodes datetimes natively, the stdlib fallback needs them converted
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
 
-    def options(self):
-        # no body
-        self.set_status(204)
-        self.finish()
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=json_default)
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-class DictReturner(tornado.web.RequestHandler):
+cors_headers = (
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Headers", "DNT,User-Agent,X-Requested-With,If-Modified-Since,Cache-Control,Content-Type,Range"),
+    ('Access-Control-Allow-Methods', 'GET, OPTIONS'),
+)
+
+class CORSMixin:
+    #shared by every handler: the same CORS headers and an empty preflight response
     def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", "*")
-        self.set_header("Access-Control-Allow-Headers", "DNT,User-Agent,X-Requested-With,If-Modified-Since,Cache-Control,Content-Type,Range")
-        self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        for header, value in cors_headers:
+            self.set_header(header, value)
+
     def options(self):
         # no body
         self.set_status(204)
         self.finish()
 
-    def initialize(self, content):
-        self.content = content
+#the version response doesn't change for the life of the process, encode it once
+version_payload = dumps({ 'version': '3.5.1',
+                          'last_build':  date.today().isoformat() })
+
+class VersionHandler(CORSMixin, tornado.web.RequestHandler):
     def get(self):
-        response = self.content.copy()
-        self.write(response)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(version_payload)
+
+class DictReturner(CORSMixin, tornado.web.RequestHandler):
+    def initialize(self, content, etag_key=None, cache=None):
+        self.content = content
+        #key of a serial in content that changes with it; used as the ETag so unchanged content gets a 304
+        self.etag_key = etag_key
+        #shared by the requests of one route: the body serialized for the last serial seen
+        self.cache = cache
+    async def get(self):
+        #the content is a manager dict, read it off the io loop
+        ioloop = tornado.ioloop.IOLoop.current()
+        serial = None
+        if self.etag_key is not None:
+            serial = await ioloop.run_in_executor(None, self.content.get, self.etag_key)
+            if serial is not None:
+                self.set_header('Etag', '"%s"' % serial)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+        #tornado's own json encoder can't handle the datetimes in running
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if serial is not None and self.cache is not None and self.cache.get('serial') == serial:
+            self.write(self.cache['body'])
+            return
+        response = await ioloop.run_in_executor(None, self.content.copy)
+        body = dumps(response)
+        if serial is not None and self.cache is not None:
+            self.cache.update({'serial': serial, 'body': body})
+        self.write(body)
 
-class WSHandler(tornado.websocket.WebSocketHandler):
-    def initialize(self, cfg, cmds, tml):
+class WSHandler(CORSMixin, tornado.websocket.WebSocketHandler):
+    def initialize(self, cfg, cmds, kills, tml, wake):
         self.config = cfg
         self.cmds = cmds
-        self.subscriptions = []
+        self.wake = wake
+        self.kills = kills
+        self.subscriptions = set()
+        #subscribed crons that are in the config, kept up to date by update_active
+        self.active_crons = set()
+        #serial of the state last sent for each subscribed cron
+        self.sent_serials = {}
+        #running/last_state payload last sent
+        self.sent_state = None
         self.tml = tml
+        #future of the last queued frame and since when it has been pending at an update tick
+        self.last_write = None
+        self.lagging_since = None
 
-    def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", "*")
-        self.set_header("Access-Control-Allow-Headers", "DNT,User-Agent,X-Requested-With,If-Modified-Since,Cache-Control,Content-Type,Range")
-        self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-    def options(self):
-        # no body
-        self.set_status(204)
-        self.finish()
     def check_origin(self, origin):
         return True
 
+    def get_compression_options(self):
+        #negotiate permessage-deflate; the json keys and command output repeat a lot
+        return {}
+
+    def update_active(self):
+        #recomputed only when the subscriptions or the configured crons change, not on every tick
+        self.active_crons = self.subscriptions & cron_names
+
+    def send(self, payload):
+        self.last_write = self.write_message(payload)
+
+    def behind(self):
+        #frames queued earlier are still unsent
+        return self.last_write is not None and not self.last_write.done()
+
+    def lagging(self):
+        #true once the client has not drained its frames for longer than ws_max_lag
+        if not self.behind():
+            self.lagging_since = None
+            return False
+        now = time.monotonic()
+        if self.lagging_since is None:
+            self.lagging_since = now
+        return now - self.lagging_since > ws_max_lag
+
 
     def open(self):
         print('New WS connection')
-        wsconnections.append(self)
-        send_data(self,True,True)
+        wsconnections.add(self)
+        tornado.ioloop.IOLoop.current().spawn_callback(sync, self, True, ())
 
     def on_message(self, message):
         print('Message received %s' % message)
         #self.write_message('received: ' % message)
         try:
-            msg = json.loads(message)
+            msg = loads(message)
         except Exception as e:
             print('Could not parse message as json')
             print(e)
             return
 
-        if 'subscribe' in msg:
-            cron = msg['subscribe']
-            self.subscriptions.append(cron)
-            send_data(self,False,False)
-        if 'unsubscribe' in msg:
-            cron = msg['unsubscribe']
-            self.subscriptions.remove(cron)
-        if 'run' in msg:
-            cron = msg['run']
-            self.cmds.append(dict({'runnow': cron}))
-        if 'killCron' in msg:
-            cron = msg['killCron']
-            self.cmds.append(dict({'killcron': cron}))
-        if 'getTimeline' in msg:
-            timeline_params = msg['getTimeline']
-            self.cmds.append(dict({'get_timeline': timeline_params}))
+        if not isinstance(msg, dict):
+            print('Message is not a json object')
+            return
+        #dispatch on the keys the message carries instead of testing for every known one
+        for key, value in msg.items():
+            handler = self.msg_handlers.get(key)
+            if handler is not None:
+                handler(self, value)
+
+    def on_subscribe(self, cron):
+        self.subscriptions.add(cron)
+        self.sent_serials.pop(cron, None)
+        self.update_active()
+        tornado.ioloop.IOLoop.current().spawn_callback(sync, self, False, (cron,))
+
+    def on_unsubscribe(self, cron):
+        self.subscriptions.discard(cron)
+        self.sent_serials.pop(cron, None)
+        self.update_active()
 
+    def on_run(self, cron):
+        self.cmds.put(dict({'runnow': cron}))
+        self.wake.set()
 
+    def on_kill_cron(self, cron):
+        tornado.ioloop.IOLoop.current().spawn_callback(self.kill_cron, cron)
+
+    async def kill_cron(self, cron):
+        #a manager write blocks until the manager answers, do it off the io loop
+        try:
+            await tornado.ioloop.IOLoop.current().run_in_executor(None, self.kills.__setitem__, cron, True)
+        except Exception as e:
+            print('Could not request kill of "%s":' % cron, e)
+
+    def on_get_timeline(self, timeline_params):
+        self.cmds.put(dict({'get_timeline': timeline_params}))
+        self.wake.set()
+
+    msg_handlers = {
+        'subscribe': on_subscribe,
+        'unsubscribe': on_unsubscribe,
+        'run': on_run,
+        'killCron': on_kill_cron,
+        'getTimeline': on_get_timeline,
+    }
 
     def on_close(self):
         print('WS connection closed')
-        wsconnections.remove(self)
+        wsconnections.discard(self)
+
+def get_shard(cron):
+    #state holds one manager dict per cron; unpickling a shard proxy costs an extra manager round-trip,
+    #so each proxy is fetched once and kept (the main loop never replaces a shard)
+    shard = shards.get(cron)
+    if shard is None:
+        shard = st.get(cron)
+        if shard is not None:
+            shards[cron] = shard
+    return shard
+
+def config_payload():
+    #serialized once per config serial, shared by update ticks and new connections
+    global config_cache
+    serial = cfg.get('serial')
+    if serial is None or config_cache[0] != serial:
+        config_cache = (serial, dumps(dict({'config': dict(cfg), 'sp_version': __version__})))
+    return config_cache[1]
 
-def send_data(con, cfgupdate, tmlupdate):
-    if cfgupdate:
-        con.write_message(json.dumps(dict({'config': dict(cfg), 'sp_version': __version__})))
+def timeline_payload():
+    return dumps(dict({'timeline': tml.copy()}))
+
+def state_summary(cron):
+    #the fields last_state is built from, re-read from the shard only when its serial moved
+    shard = get_shard(cron)
+    serial = shard.get('serial')
+    summary = summaries.get(cron)
+    if serial is None or summary is None or summary[0] != serial:
+        srcron = shard.copy()
+        summary = (srcron.get('serial'), srcron.get('last_run', ''), srcron.get('failed', 0), len(srcron.get('results', {})))
+        summaries[cron] = summary
+    return summary
+
+def state_payload():
     srrng = rng.copy()
-    rng_names = []
-    for cron in srrng:
-        rng_names.append(srrng[cron]['name'])
-        if 'started' in srrng[cron]:
-            srrng[cron]['started'] = srrng[cron]['started'].isoformat()
-    srst = st.copy()
+    rng_names = {entry['name'] for entry in srrng.values()}
     lastst = {}
-    for cron in srst:
-        if 'last_run' in srst[cron] and srst[cron]['last_run'] != '':
+    for cron in st.keys():
+        serial, last_run, failed, result_count = state_summary(cron)
+        if last_run != '':
             lastst[cron] = {}
-            lastst[cron]['last_run'] = srst[cron]['last_run'].isoformat()
-            if 'results' in srst[cron] and len(srst[cron]['results']) > 0:
-                lastst[cron]['result_ok'] = True
+            lastst[cron]['last_run'] = last_run
+            if result_count > 0:
+                #a finished cron is only flagged when every target failed
                 false_result_number = 0
-                for tgt_key in srst[cron]['results']:
-                    tgt = srst[cron]['results'][tgt_key]
-                    if cron not in rng_names:
-                        if 'retcode' not in tgt or (tgt['retcode'] != 0 and tgt['retcode'] != "0"):
-                            false_result_number += 1
-                    if false_result_number == len(srst[cron]['results']):
-                        lastst[cron]['result_ok'] = False
+                if cron not in rng_names:
+                    false_result_number = failed
+                lastst[cron]['result_ok'] = false_result_number != result_count
             else:
                 lastst[cron]['result_ok'] = False
 
-    con.write_message((json.dumps(dict({'running': srrng, 'last_state': lastst}))))
-    for cron in cfg['crons']:
-        if cron in con.subscriptions:
-            srcron = st[cron].copy()
-            if 'next_run' in srcron:
-                srcron['next_run'] = srcron['next_run'].isoformat()
-            if 'last_run' in srcron:
-                srcron['last_run'] = srcron['last_run'].isoformat()
-
-            if 'results' in srcron:
-                for m in srcron['results']:
-                    if 'starttime' in srcron['results'][m] and srcron['results'][m]['starttime'] != '':
-                        srcron['results'][m]['starttime'] = srcron['results'][m]['starttime'].isoformat()
-                    if 'endtime' in srcron['results'][m] and srcron['results'][m]['endtime'] != '':
-                        srcron['results'][m]['endtime'] = srcron['results'][m]['endtime'].isoformat()
-
-            con.write_message(json.dumps(dict({cron: srcron})))
-
-    if tmlupdate:
-        con.write_message((json.dumps(dict({'timeline': tml.copy()}))))
-
+    #datetimes are encoded as isoformat strings by dumps
+    return dumps(dict({'running': srrng, 'last_state': lastst}))
 
-def ws_update():
+def fetch_crons(wanted):
+    #wanted maps each subscribed cron to the serials its connections were last sent;
+    #a shard is copied and serialized once, and only when some connection is behind
+    fetched = {}
+    for cron, sent in wanted.items():
+        shard = get_shard(cron)
+        if shard is None:
+            continue
+        serial = shard.get('serial')
+        if serial is None or any(s != serial for s in sent):
+            srcron = shard.copy()
+            #the change serial and the failure counter are internal bookkeeping, not part of the cron state sent to clients
+            serial = srcron.pop('serial', None)
+            srcron.pop('failed', None)
+            fetched[cron] = (serial, dumps(dict({cron: srcron})))
+    return fetched
 
-    tornado.ioloop.IOLoop.current().add_timeout(timedelta(seconds=2), ws_update)
-
-    global cfgserial
-    cfgupdate = False
+def collect_updates(with_state, wanted):
+    #runs in a worker thread, every manager round-trip of a tick happens off the io loop
+    global cfgserial, cron_names, tmlserial
+    cfgpayload = None
     if cfgserial != cfg['serial']:
         cfgserial = cfg['serial']
-        cfgupdate = True
-
-
-    global tmlserial
-    tmlupdate = False
+        cron_names = set(cfg['crons'])
+        cfgpayload = config_payload()
+    tmlpayload = None
     if 'id' in tml:
         if tmlserial != tml['id']:
             tmlserial = tml['id']
-            tmlupdate = True
+            tmlpayload = timeline_payload()
+    stpayload = state_payload() if with_state else None
+    return cfgpayload, tmlpayload, stpayload, fetch_crons(wanted)
+
+def collect_initial(full, wanted):
+    #payloads for a new connection (full) or a new subscription, also run in a worker thread;
+    #the cron names are re-read so a subscription before the first update tick or right after
+    #a reload is checked against the current config
+    global cron_names
+    cron_names = set(cfg.get('crons', {}))
+    wanted = {cron: sent for cron, sent in wanted.items() if cron in cron_names}
+    if full:
+        return config_payload(), timeline_payload(), state_payload(), fetch_crons(wanted)
+    return None, None, None, fetch_crons(wanted)
+
+def send_data(con, cfgpayload, tmlpayload, stpayload, fetched, snapshots=True):
+    #every payload is serialized once by the caller and shared between connections
+    if cfgpayload is not None:
+        con.send(cfgpayload)
+    #state frames are snapshots: for a client that is behind they are held back rather than queued,
+    #and since sent_state/sent_serials stay as they were it gets the latest ones once it catches up
+    if not snapshots:
+        if tmlpayload is not None:
+            con.send(tmlpayload)
+        return
+    #an idle tick produces the same running/last_state payload, which the client already has
+    if stpayload is not None and stpayload != con.sent_state:
+        con.send(stpayload)
+        con.sent_state = stpayload
+    #walk the few subscribed crons instead of every configured one
+    for cron in con.active_crons:
+        if cron not in fetched:
+            continue
+        serial, payload = fetched[cron]
+        #crons whose state did not change since the last send are skipped
+        if serial is not None and con.sent_serials.get(cron) == serial:
+            continue
+        con.sent_serials[cron] = serial
+        con.send(payload)
+
+    if tmlpayload is not None:
+        con.send(tmlpayload)
+
+async def sync(con, full, crons):
+    ioloop = tornado.ioloop.IOLoop.current()
+    wanted = {cron: [None] for cron in (con.active_crons if full else crons)}
+    payloads = await ioloop.run_in_executor(None, collect_initial, full, wanted)
+    for conn in wsconnections:
+        conn.update_active()
+    try:
+        send_data(con, *payloads)
+    except tornado.websocket.WebSocketClosedError:
+        pass
+
+async def ws_update():
+    ioloop = tornado.ioloop.IOLoop.current()
+    #consecutive failed updates, used to back off and to log a failure streak only once
+    failures = 0
+    while True:
+        #the scheduler and the jobs set changed after every write; without one, still refresh every ws_interval
+        await ioloop.run_in_executor(None, changed.wait, ws_interval)
+        changed.clear()
+        #let a burst of writes settle into one update
+        await asyncio.sleep(ws_coalesce)
+        try:
+            conns = list(wsconnections)
+            wanted = {}
+            for con in conns:
+                for cron in con.active_crons:
+                    wanted.setdefault(cron, []).append(con.sent_serials.get(cron))
+            cfgpayload, tmlpayload, stpayload, fetched = await ioloop.run_in_executor(None, collect_updates, len(conns) > 0, wanted)
+            if cfgpayload is not None:
+                #the config changed: subscriptions to crons added by it become active now,
+                #so fetch those as well instead of leaving them to a later tick
+                added = {}
+                for con in wsconnections:
+                    con.update_active()
+                for con in conns:
+                    for cron in con.active_crons:
+                        if cron not in wanted:
+                            added.setdefault(cron, []).append(con.sent_serials.get(cron))
+                if added:
+                    fetched.update(await ioloop.run_in_executor(None, fetch_crons, added))
+            #write_message only queues the frame, slow clients don't hold up the others;
+            #a connection that closed mid-tick is skipped here and dropped by its on_close
+            for con in conns:
+                if con.lagging():
+                    print('Closing WS connection that does not keep up with updates')
+                    con.close()
+                    continue
+                try:
+                    send_data(con, cfgpayload, tmlpayload, stpayload, fetched, not con.behind())
+                except tornado.websocket.WebSocketClosedError:
+                    continue
+        except (OSError, EOFError) as e:
+            #the manager is unreachable (broken pipe, refused or missing socket once the main process died);
+            #nothing can be served anymore
+            print('Lost the connection to the state manager, stopping the api:', e)
+            ioloop.stop()
+            return
+        except Exception as e:
+            failures += 1
+            if failures == 1:
+                print('Exception triggered in ws_update(), backing off until it recovers:', e)
+            await asyncio.sleep(min(ws_interval * failures, ws_max_backoff))
+        else:
+            if failures:
+                print('ws_update() recovered after %d failed updates' % failures)
+                failures = 0
 
-    if len(wsconnections) > 0:
-        for con in wsconnections:
-            send_data(con, cfgupdate, tmlupdate)
 
+def start(port, config, running, state, commands, killcrons, bad_crons, timeline, wake, stchanged):
+    #tornado runs on asyncio; use the uvloop event loop when it is installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
-def start(port, config, running, state, commands, bad_crons, timeline ):
     global cfg
     cfg = config
     global wsconnections
-    wsconnections = []
+    #open websocket handlers; per-connection state lives on the handler itself
+    wsconnections = set()
     global rng
     rng = running
     global cfgserial
     cfgserial = ''
+    global cron_names
+    cron_names = set(config.get('crons', {}))
+    global config_cache
+    config_cache = (None, None)
     global st
     st = state
+    global shards
+    shards = {}
+    global summaries
+    summaries = {}
     
     global tmlserial
     tmlserial = ''
     global tml
     tml = timeline
+    global changed
+    changed = stchanged
 
     application = tornado.web.Application([
-        (r"/ws", WSHandler, dict(cfg=config,cmds=commands,tml=timeline)),
+        (r"/ws", WSHandler, dict(cfg=config,cmds=commands,kills=killcrons,tml=timeline,wake=wake)),
         (r"/version", VersionHandler),
-        (r"/config", DictReturner, dict(content=config)),
+        (r"/config", DictReturner, dict(content=config, etag_key='serial', cache={})),
         (r"/running", DictReturner, dict(content=running)),
-        (r"/timeline", DictReturner, dict(content=timeline))
-    ])
+        (r"/timeline", DictReturner, dict(content=timeline, etag_key='serial', cache={}))
+    ],
+        #ping websocket clients so dead connections are closed instead of accumulating
+        websocket_ping_interval=30)
 
     application.listen(port)
     ioloop =  tornado.ioloop.IOLoop.current()
-    ioloop.add_timeout(timedelta(seconds=2), ws_update)
+    ioloop.spawn_callback(ws_update)
     ioloop.start()
@@ -2,17 +2,55 @@
 
 from saltpeter import api, version
 import json
+import hashlib
 import os
 import argparse
 import re
 import yaml
 import time
-from sys import exit
+import random
+import salt.client
+import salt.config
+import salt.runner
+from sys import exit, intern
 from datetime import datetime,timedelta,date,timezone
 from crontab import CronTab
 import multiprocessing
+import queue
+import threading
 #from pprint import pprint
 
+runner = None
+indexer = None
+indexqueue = None
+logfiles = {}
+indexday = None
+indexname = None
+#the results this job last wrote to its cron's state; only kept by an exclusive instance (no allow_overlap
+#when it started), which run() keeps every other instance of the cron from starting alongside, even after
+#a config reload, so saveresults doesn't have to read them back through the manager
+ownresults = None
+#set whenever state, running, config or timeline change, so the api pushes updates without waiting for its tick
+changed = None
+
+#libyaml's loader when pyyaml was built with it
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+parsedfiles = {}
+
+log_templates = {
+    'start': "###### Starting {instance} at {time} ################\n",
+    'machine_start': "###### Starting {instance} on {machine} at {time} ################\n",
+    'no_machines': "!!!!!! No targets matched for {instance} !!!!!!\n",
+    'end': "###### Finished {instance} at {time} ################\n",
+    'overlap': "###### Overlap detected on {instance} at {time} ################\n",
+}
+
+log_result_template = """########## {machine} from {instance} ################
+**** Exit Code {code} ******
+{out}
+####### END {machine} from {instance} at {time} #########
+"""
+
 def readconfig(configdir):
     global bad_files
     config = {}
@@ -20,9 +58,17 @@ def readconfig(configdir):
         if not re.match('^.+\.yaml$',f):
             continue
         try:
-            config_string = open(configdir+'/'+f,'r').read()
+            config_path = configdir+'/'+f
+            stat = os.stat(config_path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
             group = f[0:-5]
-            loaded_config = yaml.load(config_string, Loader=yaml.FullLoader)
+            #only parse files that changed since they were last read
+            if f in parsedfiles and parsedfiles[f][0] == stamp:
+                loaded_config = parsedfiles[f][1]
+            else:
+                config_string = open(config_path,'r').read()
+                loaded_config = yaml.load(config_string, Loader=yaml_loader)
+                parsedfiles[f] = (stamp, loaded_config)
             add_config = {}
             for cron in loaded_config:
                 if parsecron(cron,loaded_config[cron]) is not False:
@@ -38,6 +84,16 @@ def readconfig(configdir):
     return config
 
 
+def configsignature(configdir):
+    #name, mtime and size of every config file; cheap to stat, and changes whenever a file does
+    signature = []
+    for entry in os.scandir(configdir):
+        if re.match('^.+\.yaml$',entry.name):
+            stat = entry.stat()
+            signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return sorted(signature)
+
+
 def parsecron(name, data, time=datetime.now(timezone.utc)):
     try:
         dow = data['dow']
@@ -91,247 +147,324 @@ def parsecron(name, data, time=datetime.now(timezone.utc)):
 
     return ret
 
-def processstart(chunk,name,group,procname,state):
+def processstart(chunk,name,group,procname,jobstate):
     results = {}
+    log_batch = []
 
+    starttime = datetime.now(timezone.utc)
     for target in chunk:
-        starttime = datetime.now(timezone.utc)
-        result = { 'ret': '', 'retcode': '',
+        results[target] = { 'ret': '', 'retcode': '',
             'starttime': starttime, 'endtime': ''}
-        #do this crap to propagate changes; this is somewhat acceptable since this object is not modified anywhere else
-        with statelocks[name]:
-            if 'results' in state[name]:
-                tmpresults = state[name]['results'].copy()
-            else:
-                tmpresults = {}
-            tmpresults[target] = result
-            tmpstate = state[name].copy()
-            tmpstate['results'] = tmpresults
-            state[name] = tmpstate
-
-        log(cron=name, group=group, what='machine_start', instance=procname,
-                time=starttime, machine=target)
-
+        log_batch.append({ 'what': 'machine_start', 'cron': name, 'group': group,
+                'instance': procname, 'time': starttime, 'machine': target })
 
+    saveresults(name, jobstate, results)
+    log_many(log_batch)
 
-def processresults(client,commands,job,name,group,procname,running,state,targets):
 
-    import salt.runner
-    opts = salt.config.master_config('/etc/salt/master')
-    runner = salt.runner.RunnerClient(opts)
+def saveresults(name, jobstate, results):
+    #merge target results into the job state with one manager write
+    #the number of targets without an ok retcode is kept alongside so readers don't rescan the results
+    with statelocks[name]:
+        if ownresults is not None:
+            tmpresults = ownresults['results']
+            failed = ownresults['failed']
+        else:
+            tmpresults = jobstate.get('results', {})
+            failed = jobstate.get('failed', 0)
+        for tgt, result in results.items():
+            previous = tmpresults.get(tgt)
+            if previous is not None and previous['retcode'] not in api.ok_retcodes:
+                failed -= 1
+            if result['retcode'] not in api.ok_retcodes:
+                failed += 1
+        tmpresults.update(results)
+        jobstate.update({ 'results': tmpresults, 'failed': failed, 'serial': time.monotonic_ns() })
+        if ownresults is not None:
+            ownresults['failed'] = failed
+    notify()
+
+
+def readresults(jobstate):
+    #the job's own copy when it is the only writer, otherwise fetched from the manager
+    if ownresults is not None:
+        return ownresults['results']
+    return jobstate.get('results', {})
+
+
+def flushresults(name, jobstate, results, procname, running, local_running):
+    #save finished targets and drop them from the running machines in one write each
+    saveresults(name, jobstate, results)
+    if local_running is not None:
+        machines = [m for m in local_running['machines'] if m not in results]
+        if len(machines) != len(local_running['machines']):
+            local_running['machines'] = machines
+            running[procname] = local_running
+            notify()
+
+
+
+def notify():
+    if changed is not None:
+        changed.set()
+
+def getrunner():
+    #one RunnerClient per job process, created only when the jobs.list_job fallback needs it
+    global runner
+    if runner is None:
+        runner = salt.runner.RunnerClient(master_opts)
+    return runner
+
+def processresults(client,killcrons,job,name,group,procname,running,jobstate,targets):
 
     jid = job['jid']
     minions = job['minions']
 
+    #local mirror of running[procname]; it is only written back to the proxy, never re-read per target
+    local_running = running.get(procname)
+    #start times are written by processstart() before this batch is processed; read them once
+    starttimes = {m: entry.get('starttime', '') for m, entry in readresults(jobstate).items()}
+
     rets = client.get_iter_returns(jid, minions, block=False, expect_minions=True,timeout=1)
     failed_returns = False
     kill = False
 
+    #returned results are buffered and written to the state, running and logs at most every 100ms
+    pending = {}
+    log_batch = []
+    flushed = time.monotonic()
+
 
     for i in rets:
-        #process commands in the loop
-        for cmd in commands:
-            if 'killcron' in cmd:
-                if cmd['killcron'] == name:
-                    commands.remove(cmd)
-                    client.run_job(minions, 'saltutil.term_job', [jid], tgt_type='list')
-                    kill = True
+        #process kill requests in the loop
+        if killcrons.pop(name, None):
+            client.run_job(minions, 'saltutil.term_job', [jid], tgt_type='list')
+            kill = True
         if kill:
             #print('break from kill in returns loop')
             break
 
         if i is not None:
             m = list(i)[0]
-            print(name, i[m])
-            if 'failed' in i[m] and i[m]['failed'] == True:
+            ret = i[m]
+            if args.debug:
+                print(name, ret)
+            if ret.get('failed') == True:
                 print(f"Getting info about job {name} jid: {jid} every 10 seconds")
                 failed_returns = True
                 continue
             else:
-                r = i[m]['retcode']
-                o = i[m]['ret']
-            result = { 'ret': o, 'retcode': r, 'starttime': state[name]['results'][m]['starttime'], 'endtime': datetime.now(timezone.utc) }
-            with statelocks[name]:
-                tmpstate = state[name].copy()
-                if 'results' not in tmpstate:
-                    tmpstate['results'] = {}
-                tmpstate['results'][m] = result
-                state[name] = tmpstate
-
-                if procname in running and m in running[procname]['machines']:
-                    tmprunning = running[procname]
-                    tmprunning['machines'].remove(m)
-                    running[procname] = tmprunning
-
-            log(what='machine_result',cron=name, group=group, instance=procname, machine=m,
-                code=r, out=o, time=result['endtime'])
+                r = ret['retcode']
+                o = ret['ret']
+            result = { 'ret': o, 'retcode': r, 'starttime': starttimes.get(m, ''), 'endtime': datetime.now(timezone.utc) }
+            pending[m] = result
+            log_batch.append({ 'what': 'machine_result', 'cron': name, 'group': group,
+                'instance': procname, 'machine': m, 'code': r, 'out': o, 'time': result['endtime'] })
+
+        if pending and time.monotonic() - flushed >= 0.1:
+            flushresults(name, jobstate, pending, procname, running, local_running)
+            log_many(log_batch)
+            pending = {}
+            log_batch = []
+            flushed = time.monotonic()
         #time.sleep(1)
 
+    if pending:
+        flushresults(name, jobstate, pending, procname, running, local_running)
+        log_many(log_batch)
+
        
     if failed_returns:
+        #minions already handled, so each poll only processes new returns
+        processed = set()
         while True:
-            #process commands in the loop
-            for cmd in commands:
-                if 'killcron' in cmd:
-                    if cmd['killcron'] == name:
-                        commands.remove(cmd)
-                        client.run_job(minions, 'saltutil.term_job', [jid], tgt_type='list')
-                        kill = True
+            #process kill requests in the loop
+            if killcrons.pop(name, None):
+                client.run_job(minions, 'saltutil.term_job', [jid], tgt_type='list')
+                kill = True
 
             if kill:
                 #print('break from kill in failed returns loop')
                 break
 
-            job_listing = runner.cmd("jobs.list_job",[jid])
-            if len(job_listing['Minions']) == len(job_listing['Result'].keys()):
-                for m in job_listing['Result'].keys():
-                    o = job_listing['Result'][m]['return']
-                    r = job_listing['Result'][m]['retcode']
-                    result = { 'ret': o, 'retcode': r, 'starttime': state[name]['results'][m]['starttime'], 'endtime': datetime.now(timezone.utc) }
-                    send_log = False
-                    with statelocks[name]:
-                        tmpstate = state[name].copy()
-                        if 'results' not in tmpstate:
-                            tmpstate['results'] = {}
-
-                        #print(f'state before check if m not in tmprresults: {state[name]}')
-                        if m not in tmpstate['results'] or tmpstate['results'][m]['endtime'] =='':
-                            tmpstate['results'][m] = result
-                            state[name] = tmpstate
-
-                            if procname in running and m in running[procname]['machines']:
-                                tmprunning = running[procname]
-                                tmprunning['machines'].remove(m)
-                                running[procname] = tmprunning
-
-                            send_log = True
-
-                    if send_log:
-                        log(what='machine_result',cron=name, group=group, instance=procname, machine=m,
-                            code=r, out=o, time=result['endtime'])
-
+            job_listing = getrunner().cmd("jobs.list_job",[jid])
+            polltime = datetime.now(timezone.utc)
+            #results already recorded from the returns iterator are kept
+            results_snap = readresults(jobstate)
+            new_results = {}
+            log_batch = []
+            listing_results = job_listing['Result']
+            for m in listing_results.keys() - processed:
+                processed.add(m)
+                listing = listing_results[m]
+                o = listing['return']
+                r = listing['retcode']
+
+                #print(f'state before check if m not in tmprresults: {jobstate}')
+                if m not in results_snap or results_snap[m]['endtime'] =='':
+                    new_results[m] = { 'ret': o, 'retcode': r, 'starttime': starttimes.get(m, ''), 'endtime': polltime }
+                    log_batch.append({ 'what': 'machine_result', 'cron': name, 'group': group,
+                        'instance': procname, 'machine': m, 'code': r, 'out': o, 'time': polltime })
+
+            if new_results:
+                flushresults(name, jobstate, new_results, procname, running, local_running)
+            log_many(log_batch)
+            if len(processed) >= len(job_listing['Minions']):
                 #print('break from failed returns loop')
                 break
-            time.sleep(10)
+
+            #wait for the next poll, but wake up early when a kill request arrives
+            next_poll = time.monotonic() + 10
+            while name not in killcrons and time.monotonic() < next_poll:
+                time.sleep(1)
 
 
-    #print(f'targets: {targets}\nminions: {minions}\nstate: {state[name]}')
+    #print(f'targets: {targets}\nminions: {minions}\nstate: {jobstate}')
+    #read the results once for the sweep; the proxy is only touched again when writing
+    minion_set = set(minions)
+    results_snap = readresults(jobstate)
+    now = datetime.now(timezone.utc)
+    log_batch = []
+    missing = {}
     for tgt in targets:
-        if tgt not in minions or tgt not in state[name]['results'] or state[name]['results'][tgt]['endtime'] == '':
-            #print(f'machine {tgt} has no output, state: {state[name]}')
-            now = datetime.now(timezone.utc)
-            if tgt in state[name]['results'] and 'starttime' in state[name]['results'][tgt]:
-                starttime = state[name]['results'][tgt]['starttime']
+        entry = results_snap.get(tgt)
+        if tgt not in minion_set or not entry or entry['endtime'] == '':
+            #print(f'machine {tgt} has no output, state: {jobstate}')
+            if entry and 'starttime' in entry:
+                starttime = entry['starttime']
             else:
-                starttime = state[name]['lastrun']
+                starttime = jobstate.get('last_run', '')
+
+            missing[tgt] = { 'ret': "Target did not return anything",
+                    'retcode': 255,
+                    'starttime': starttime,
+                    'endtime': now }
+            log_batch.append({ 'what': 'machine_result', 'cron': name, 'group': group, 'instance': procname,
+                'machine': tgt, 'code': 255, 'out': "Target did not return anything", 'time': now })
 
-            log(what='machine_result',cron=name, group=group, instance=procname, machine=tgt,
-                code=255, out="Target did not return anything", time=now)
+    #mark every target that returned nothing with a single state and running write
+    if missing:
+        flushresults(name, jobstate, missing, procname, running, local_running)
 
-            with statelocks[name]:
-                tmpstate = state[name].copy()
-                tmpstate['results'][tgt] = { 'ret': "Target did not return anything",
-                        'retcode': 255,
-                        'starttime': starttime,
-                        'endtime': now }
-                state[name] = tmpstate
+    log_many(log_batch)
 
-                if procname in running and m in running[procname]['machines']:
-                    tmprunning = running[procname]
-                    tmprunning['machines'].remove(m)
-                    running[procname] = tmprunning
 
 
+def runjob(*args):
+    #job processes exit without running atexit handlers, so flush queued logs here
+    try:
+        run(*args)
+    finally:
+        stopindexer()
+        closelogfiles()
+
 
-def run(name,data,procname,running,state,commands):
+def run(name,data,procname,running,jobstate,killcrons):
+    #without overlap this instance is the only writer of the cron's results until it ends (see ownresults);
+    #the policy is frozen per running instance in exclusives, which the api doesn't serve
+    exclusive = data.get('allow_overlap') != 'i know what i am doing!'
     #do this check here for the purpose of avoiding sync logging in the main program
-    for instance in running.keys():
-        if name == running[instance]['name']:
+    #the check and the registration in running happen under the cron's lock, so two instances
+    #starting at the same time can't both miss each other; logging waits until the lock is released
+    with statelocks[name]:
+        #one snapshot of running instead of a proxy read per instance
+        overlapping = [instance for instance, info in running.items() if name == info['name']]
+        blocked = bool(overlapping) and exclusive
+        if overlapping and not exclusive:
+            #an exclusive instance keeps its guarantee even if a config reload now allows overlap
+            held = exclusives.copy()
+            blocked = any(held.get(instance) for instance in overlapping)
+        now = datetime.now(timezone.utc)
+        if not blocked:
+            exclusives[procname] = exclusive
+            running[procname]=  { 'started': now, 'name': name , 'machines': [] }
+    if overlapping:
+        for instance in overlapping:
             log(what='overlap', cron=name, group=data['group'], instance=instance,
                  time=datetime.now(timezone.utc))
-            with statelocks[name]:
-                tmpstate = state[name].copy()
-                tmpstate['overlap'] = True
-                state[name] = tmpstate
-            if 'allow_overlap' not in data or data['allow_overlap'] != 'i know what i am doing!':
-                return
-
-    import salt.client
-    salt = salt.client.LocalClient()
+        jobstate.update({ 'overlap': True, 'serial': time.monotonic_ns() })
+        notify()
+        if blocked:
+            return
+
+    client = salt.client.LocalClient()
     targets = data['targets']
     target_type = data['target_type']
-    cmdargs = [data['command']]
     env = {'SP_JOB_NAME': name, 'SP_JOB_INSTANCE_NAME':procname}
-    cmdargs.append('env='+str(env))
+    #serialize the env once as json (salt parses it as yaml); cmdargs is reused unchanged for every batch
+    env_arg = 'env='+json.dumps(env)
+    cmdargs = [data['command'], env_arg]
     if 'cwd' in data:
         cmdargs.append('cwd='+data['cwd'])
     if 'user' in data:
         cmdargs.append('runas='+data['user'])
     if 'timeout' in data:
         cmdargs.append('timeout='+str(data['timeout']))
+    cmdargs = tuple(cmdargs)
 
-    now = datetime.now(timezone.utc)
-    running[procname]=  { 'started': now, 'name': name , 'machines': []}
-    with statelocks[name]:
-        tmpstate = state[name].copy()
-        tmpstate['last_run'] = now
-        tmpstate['overlap'] = False
-        state[name] = tmpstate
+    jobstate.update({ 'last_run': now, 'overlap': False, 'serial': time.monotonic_ns() })
+    notify()
     log(cron=name, group=data['group'], what='start', instance=procname, time=now)
     
 
     ## ping the minions and parse the result
-    ret_job = salt.run_job(targets, 'test.ping', tgt_type=target_type)
+    ret_job = client.run_job(targets, 'test.ping', tgt_type=target_type)
     jid = ret_job['jid']
-    jid_targets = ret_job['minions']
+    #minion ids are used as keys and compared in every results/running lookup, intern them once
+    jid_targets = [intern(m) for m in ret_job['minions']]
 
     poll_interval = 2
-    poll_count = 0
+    #use the monotonic clock so wall clock jumps don't stretch or cut the wait
+    poll_deadline = time.monotonic() + poll_interval * 10
     targets_up = []
     targets_down = []
     minion_ret = {}
     while True:
-        minion_ret_raw = list(salt.get_cli_returns(jid,targets))
+        minion_ret_raw = list(client.get_cli_returns(jid,targets))
         if minion_ret_raw:
-            minion_ret = {key: value['ret'] for m in minion_ret_raw for key, value in m.items()}
+            minion_ret = {intern(key): value['ret'] for m in minion_ret_raw for key, value in m.items()}
             targets_up = list(minion_ret)
             break
-        if poll_count == 10:
+        if time.monotonic() >= poll_deadline:
             break
         # Wait before polling again
         time.sleep(poll_interval)
-        poll_count = poll_count + 1
 
     targets_down = list(set(jid_targets) - set(targets_up))
     for item in targets_down:
         minion_ret[item] = False
 
     targets_list = jid_targets.copy()
-    print(name, minion_ret)
-    print(name, targets_list)
+    if args.debug:
+        print(name, minion_ret)
+        print(name, targets_list)
     ###
 
-    dead_targets = []
+    #split the targets in one pass instead of removing from the list while scanning it
+    dead_targets = [tgt for tgt in targets_list if minion_ret[tgt] == False]
+    dead_set = set(dead_targets)
+    targets_list = [tgt for tgt in targets_list if tgt not in dead_set]
+    pingtime = datetime.now(timezone.utc)
+    results = {}
+    for tgt in dead_targets:
+        results[tgt] = { 'ret': "Target did not respond",
+                'retcode': 255,
+                'starttime': now,
+                'endtime': pingtime }
     with statelocks[name]:
-        tmpstate = state[name]
-        tmpstate['targets'] = targets_list.copy()
-        tmpstate['results'] = {}
-
-        for tgt in targets_list.copy():
-            if minion_ret[tgt] == False:
-                targets_list.remove(tgt)
-                tmpstate['results'][tgt] = { 'ret': "Target did not respond",
-                        'retcode': 255,
-                        'starttime': now,
-                        'endtime': datetime.now(timezone.utc) }
-
-        state[name] = tmpstate
+        jobstate.update({ 'targets': jid_targets.copy(), 'results': results, 'failed': len(results),
+            'serial': time.monotonic_ns() })
+    #no other instance of the cron can start while this one runs, so its results are kept locally
+    global ownresults
+    if exclusive:
+        ownresults = { 'results': dict(results), 'failed': len(results) }
+    notify()
     if len(targets_list) == 0:
-        log(cron=name, group=data['group'], what='no_machines', instance=procname, time=datetime.now(timezone.utc))
-        log(cron=name, group=data['group'], what='end', instance=procname, time=datetime.now(timezone.utc))
+        endtime = datetime.now(timezone.utc)
+        log(cron=name, group=data['group'], what='no_machines', instance=procname, time=endtime)
+        log(cron=name, group=data['group'], what='end', instance=procname, time=endtime)
         return
     if 'number_of_targets' in data and data['number_of_targets'] != 0:
-        import random
         #targets chosen at random
         random.shuffle(targets_list)
         targets_list = targets_list[:data['number_of_targets']]
@@ -346,90 +479,171 @@ def run(name,data,procname,running,state,commands):
 
                 try:
                     # this should be nonblocking
-                    job = salt.run_job(chunk, 'cmd.run', cmdargs,
+                    job = client.run_job(chunk, 'cmd.run', cmdargs,
                             tgt_type='list', listen=True)
 
                     # update running list and state
                     running[procname]=  { 'started': now, 'name': name, 'machines': chunk }
-                    processstart(chunk,name,data['group'],procname,state)
+                    notify()
+                    processstart(chunk,name,data['group'],procname,jobstate)
                     #this should be blocking
-                    processresults(salt,commands,job,name,data['group'],procname,running,state,chunk)
+                    processresults(client,killcrons,job,name,data['group'],procname,running,jobstate,chunk)
                     chunk = []
                 except Exception as e:
                     print('Exception triggered in run() at "batch_size" condition', e)
                     chunk = []
     else:
         running[procname]=  { 'started': now, 'name': name, 'machines': targets_list }
+        notify()
         starttime = datetime.now(timezone.utc)
 
         try:
-            job = salt.run_job(targets_list, 'cmd.run', cmdargs,
+            job = client.run_job(targets_list, 'cmd.run', cmdargs,
                     tgt_type='list', listen=True)
-            processstart(targets_list,name,data['group'],procname,state)
+            processstart(targets_list,name,data['group'],procname,jobstate)
             #this should be blocking
-            processresults(salt,commands,job,name,data['group'],procname,running,state,targets_list)
+            processresults(client,killcrons,job,name,data['group'],procname,running,jobstate,targets_list)
 
         except Exception as e:
             print('Exception triggered in run()', e)
 
     log(cron=name, group=data['group'], what='end', instance=procname, time=datetime.now(timezone.utc))
 
+def getlogfile(logfile_name):
+    #log files stay open for the life of the process instead of being reopened for every entry
+    if logfile_name not in logfiles:
+        logfiles[logfile_name] = open(logfile_name, 'ab', buffering=1<<17)
+    return logfiles[logfile_name]
+
+
+def closelogfiles():
+    for logfile_name in list(logfiles):
+        logfiles.pop(logfile_name).close()
+
+
 def debuglog(content):
-    logfile = open(args.logdir+'/'+'debug.log','a')
-    logfile.write(content)
+    logfile = getlogfile(args.logdir+'/'+'debug.log')
+    logfile.write(content.encode('utf-8'))
     logfile.flush()
-    logfile.close()
 
 
 def log(what, cron, group, instance, time, machine='', code=0, out='', status=''):
-    try:
-        logfile_name = args.logdir+'/'+cron+'.log'
-        logfile = open(logfile_name,'a')
-    except Exception as e:
-        print(f"Could not open logfile {logfile_name}: ", e)
+    log_many([{ 'what': what, 'cron': cron, 'group': group, 'instance': instance, 'time': time,
+                'machine': machine, 'code': code, 'out': out, 'status': status }])
+
+
+def log_many(entries):
+    #entries take the same keys as log(); each cron log file is opened and written once per batch
+    bycron = {}
+    for entry in entries:
+        bycron.setdefault(entry['cron'], []).append(entry)
+
+    for cron in bycron:
+        try:
+            logfile_name = args.logdir+'/'+cron+'.log'
+            logfile = getlogfile(logfile_name)
+        except Exception as e:
+            print(f"Could not open logfile {logfile_name}: ", e)
+            continue
+
+        #flush once per batch so the log can still be followed while the job runs
+        logfile.write(''.join(logcontent(**entry) for entry in bycron[cron]).encode('utf-8'))
+        logfile.flush()
+
+        for entry in bycron[cron]:
+            logindex(**entry)
+
+
+def logcontent(what, cron, group, instance, time, machine='', code=0, out='', status=''):
+    template = log_templates.get(what, log_result_template)
+    return template.format(instance=instance, time=time, machine=machine, code=code, out=out)
+
+
+def logindex(what, cron, group, instance, time, machine='', code=0, out='', status=''):
+    if not use_es and not use_opensearch:
         return
+    doc = { 'job_name': cron, "group": group, "job_instance": instance, '@timestamp': time,
+            'return_code': code, 'machine': machine, 'output': out, 'msg_type': what }
+    index_name = getindexname()
+    startindexer()
+    indexqueue.put_nowait((index_name, doc))
+
+
+def getindexname():
+    #the daily index name only changes at midnight, so it is formatted once per day
+    global indexday
+    global indexname
+    today = date.today()
+    if today != indexday:
+        indexday = today
+        indexname = 'saltpeter-%s' % today.strftime('%Y.%m.%d')
+    return indexname
+
+
+def startindexer():
+    #one indexing thread per process; job processes are forked and don't inherit threads
+    global indexer
+    global indexqueue
+    if indexer is None:
+        indexqueue = queue.Queue()
+        indexer = threading.Thread(target=indexdocs, name='indexer', daemon=True)
+        indexer.start()
+
+
+def stopindexer():
+    #send everything still queued before the process exits
+    global indexer
+    if indexer is not None:
+        indexqueue.put(None)
+        indexer.join()
+        indexer = None
+
+
+def indexdocs():
+    #flush queued documents with one bulk request every 500 docs or 1 second, whichever comes first
+    docs = []
+    deadline = None
+    stop = False
+    while not stop:
+        try:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            item = indexqueue.get(timeout=timeout)
+            if item is None:
+                stop = True
+            else:
+                docs.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + 1
+        except queue.Empty:
+            pass
 
-    if what == 'start':
-        content = "###### Starting %s at %s ################\n" % (instance, time)
-    elif what == 'machine_start':
-        content = "###### Starting %s on %s at %s ################\n" % (instance, machine, time)
-    elif what == 'no_machines':
-        content = "!!!!!! No targets matched for %s !!!!!!\n" % instance
-    elif what == 'end':
-        content = "###### Finished %s at %s ################\n" % (instance, time)
-    elif what == 'overlap':
-        content = "###### Overlap detected on %s at %s ################\n" % (instance, time)
-    else:
-        content = """########## %s from %s ################
-**** Exit Code %d ******
-%s
-####### END %s from %s at %s #########
-""" % (machine, instance, code, out, machine, instance, time)
+        if docs and (stop or len(docs) >= 500 or time.monotonic() >= deadline):
+            bulkindex(docs)
+            docs = []
+            deadline = None
 
-    logfile.write(content)
-    logfile.flush()
-    logfile.close()
+
+def bulkindex(docs):
+    actions = [{ '_op_type': 'index', '_index': index_name, '_source': doc } for index_name, doc in docs]
 
     if use_es:
-        doc = { 'job_name': cron, "group": group, "job_instance": instance, '@timestamp': time,
-                'return_code': code, 'machine': machine, 'output': out, 'msg_type': what } 
-        index_name = 'saltpeter-%s' % date.today().strftime('%Y.%m.%d')
         try:
             #es.indices.create(index=index_name, ignore=400)
-            es.index(index=index_name, doc_type='_doc', body=doc, request_timeout=20)
+            ok, failed = es_helpers.bulk(es, actions, stats_only=True, raise_on_error=False,
+                    chunk_size=500, request_timeout=20)
+            if failed:
+                print("Can't write %d documents to elasticsearch" % failed)
         except Exception as e:
-            print("Can't write to elasticsearch", doc)
+            print("Can't write to elasticsearch")
             print(e)
 
     if use_opensearch:
-        doc = { 'job_name': cron, "group": group, "job_instance": instance, '@timestamp': time,
-                'return_code': code, 'machine': machine, 'output': out, 'msg_type': what } 
-        index_name = 'saltpeter-%s' % date.today().strftime('%Y.%m.%d')
         try:
-            #es.indices.create(index=index_name, ignore=400)
-            opensearch.index(index=index_name, body=doc, request_timeout=20)
+            ok, failed = opensearch_helpers.bulk(opensearch, actions, stats_only=True, raise_on_error=False,
+                    chunk_size=500, request_timeout=20)
+            if failed:
+                print("Can't write %d documents to opensearch" % failed)
         except Exception as e:
-            #print("Can't write to opensearch", doc)
             print(e)
 
 def gettimeline(client, start_date, end_date, req_id, timeline, index_name):
@@ -453,43 +667,69 @@ def gettimeline(client, start_date, end_date, req_id, timeline, index_name):
                     }  
                     ]
                 }
-            }
+            },
+        # only fetch the fields the timeline uses, already ordered by the server
+        "_source": ["job_name", "job_instance", "@timestamp", "return_code", "msg_type"],
+        "sort": [{"@timestamp": {"order": "asc"}}]
         }
-    result = client.search(index=index_name, body=query, scroll='1m')
+    result = client.search(index=index_name, body=query, scroll='1m', size=1000)
     new_timeline_content = []
-    scroll_id = None
+    #digest of the fetched entries, compared instead of pulling the whole stored timeline through the manager
+    digest = hashlib.sha1()
+    scroll_ids = set()
     try:
         if 'hits' in result:
             # Use the scroll API to fetch all documents
             while True:
                 scroll_id = result['_scroll_id']
+                scroll_ids.add(scroll_id)
                 hits = result['hits']['hits']
                 if not hits:
                     break  # Break out of the loop when no more documents are returned
 
                 for hit in hits:
-                    cron = hit['_source']['job_name']
-                    job_instance = hit['_source']['job_instance']
-                    timestamp = hit['_source']['@timestamp']
-                    ret_code = hit['_source']['return_code']
-                    msg_type = hit['_source']['msg_type']
-                    new_timeline_content.append({'cron': cron, 'timestamp': timestamp, 'ret_code': ret_code, 'msg_type': msg_type, 'job_instance':job_instance })
+                    src = hit['_source']
+                    entry = {'cron': src['job_name'], 'timestamp': src['@timestamp'],
+                        'ret_code': src['return_code'], 'msg_type': src['msg_type'], 'job_instance': src['job_instance'] }
+                    new_timeline_content.append((f"{entry['timestamp']}|{entry['cron']}|{entry['job_instance']}|{entry['msg_type']}|{entry['ret_code']}\n", entry))
                 result = client.scroll(scroll_id=scroll_id, scroll='1m')
 
-    except TransportError as e:
-        # Handle the transport error
-        print(f"TransportError occurred: {e}")
+    except Exception as e:
+        # A failed search, scroll or malformed hit leaves the timeline with what was fetched so far
+        print(f"Could not fetch the timeline: {e}")
     finally:
-        if scroll_id:
-            # Clear the scroll context when done
-            client.clear_scroll(scroll_id=scroll_id)
-    
-    new_timeline_content = sorted(new_timeline_content, key=lambda x: x['timestamp'])
-
-    if ('content' not in timeline) or (new_timeline_content != timeline['content']):
-        timeline['content'] = new_timeline_content
-        timeline['id'] = req_id
-        timeline['serial'] = datetime.now(timezone.utc).timestamp()
+        if scroll_ids:
+            # Clear every scroll context the search used in one request; they expire anyway, so a failure is only reported
+            try:
+                client.clear_scroll(body={'scroll_id': list(scroll_ids)})
+            except Exception as e:
+                print(f"Could not clear scroll: {e}")
+
+    # the server only orders by @timestamp and may return tied entries (a batch's machine_start) in any order,
+    # so order them by every field before hashing; identical timelines then get the same digest
+    new_timeline_content.sort(key=lambda line_entry: line_entry[0])
+    for line, entry in new_timeline_content:
+        digest.update(line.encode())
+    new_timeline_content = [entry for line, entry in new_timeline_content]
+
+    timeline_hash = digest.hexdigest()
+    if timeline.get('hash') != timeline_hash:
+        timeline.update({ 'content': new_timeline_content, 'hash': timeline_hash,
+            'id': req_id, 'serial': datetime.now(timezone.utc).timestamp() })
+        notify()
+
+def orjsonserializer():
+    #opensearch serializer backed by orjson; raises ImportError when orjson is not installed
+    import orjson
+    from opensearchpy.serializer import JSONSerializer
+
+    class OrjsonSerializer(JSONSerializer):
+        def dumps(self, data):
+            if isinstance(data, (str, bytes)):
+                return data
+            return orjson.dumps(data, default=self.default).decode('utf-8')
+
+    return OrjsonSerializer()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -515,6 +755,9 @@ def main():
     parser.add_argument('-i', '--index', default='saltpeter',\
             help='Elasticsearch/Opensearch index name')
 
+    parser.add_argument('-d', '--debug', action='store_true' ,\
+            help='Print minion returns and job targets')
+
     parser.add_argument('-v', '--version', action='store_true' ,\
             help='Print version and exit')
 
@@ -533,6 +776,8 @@ def main():
     use_es = False
     global use_opensearch
     use_opensearch = False
+    global master_opts
+    master_opts = salt.config.master_config('/etc/salt/master')
     bad_files = []
     last_run = {}
     processlist = {}
@@ -540,11 +785,30 @@ def main():
     manager = multiprocessing.Manager()
     running = manager.dict()
     config = manager.dict()
+    #state maps each cron name to its own manager dict, so jobs and the main loop update single keys
+    #instead of rewriting the whole job state; stateshards keeps the proxies local to the main process
     state = manager.dict()
+    stateshards = {}
+    #every write to a shard also sets its 'serial', so the api can skip sending unchanged crons
+    #next_run is only written when it moves; nextruns holds the last value written per cron
+    nextruns = {}
     global statelocks
     statelocks = {}
-    commands = manager.list()
-    bad_crons = manager.list()
+    #overlap policy of each running instance by procname, kept out of running so the api doesn't serve it
+    global exclusives
+    exclusives = manager.dict()
+    #one-shot requests from the api; the main loop is the only reader and drains them every tick
+    commands = multiprocessing.Queue()
+    #set by the api after queueing a command so the main loop wakes up early
+    wake = multiprocessing.Event()
+    global changed
+    changed = multiprocessing.Event()
+    #pending run requests by cron name
+    runnow_crons = set()
+    #kill requests indexed by cron name so job processes can pop them without scanning commands
+    killcrons = manager.dict()
+    #only the main process parses crons, so this does not need to go through the manager
+    bad_crons = []
     timeline = manager.dict()
 
     #timeline['content'] = []
@@ -553,71 +817,106 @@ def main():
     
     #start the api
     if args.api:
-        a = multiprocessing.Process(target=api.start, args=(args.port,config,running,state,commands,bad_crons,timeline), name='api')
+        a = multiprocessing.Process(target=api.start, args=(args.port,config,running,state,commands,killcrons,bad_crons,timeline,wake,changed), name='api')
         a.start()
 
     if args.elasticsearch != '':
         from elasticsearch import Elasticsearch
+        global es_helpers
+        from elasticsearch import helpers as es_helpers
         use_es = True
         global es
         es = Elasticsearch(args.elasticsearch,maxsize=50)
 
     if args.opensearch != '':
         from opensearchpy import OpenSearch
+        global opensearch_helpers
+        from opensearchpy import helpers as opensearch_helpers
         use_opensearch = True
         global opensearch
-        opensearch = OpenSearch(args.opensearch,maxsize=50,useSSL=False,verify_certs=False)
+        opensearch_options = {}
+        try:
+            opensearch_options['serializer'] = orjsonserializer()
+        except ImportError:
+            pass
+        opensearch = OpenSearch(args.opensearch,maxsize=50,useSSL=False,verify_certs=False,**opensearch_options)
 
 
     #main loop
     prev = datetime.now(timezone.utc)
+    crons = None
+    configstamp = None
+    #whether the last wait ended because the api set wake
+    woken = False
     
     while True:
         now = datetime.now(timezone.utc)
         
-        newconfig = readconfig(args.configdir)
-        if 'crons' not in config or config['crons'] != newconfig:
-            config['crons'] = newconfig
-            config['serial'] = now.timestamp()
-        
+        #the main loop is the only writer of config, so it works from its own copy of the crons;
+        #the files are only parsed again when one of them was added, removed or modified
+        newsignature = configsignature(args.configdir)
+        if newsignature != configstamp:
+            configstamp = newsignature
+            newconfig = readconfig(args.configdir)
+            if newconfig != crons:
+                crons = newconfig
+                config['crons'] = crons
+                config['serial'] = now.timestamp()
+                notify()
+
+        #sort new commands by kind so each cron only needs a set lookup
+        timeline_requests = []
+        while True:
+            try:
+                #the api sets wake right after put(), but the queue's feeder thread may not have
+                #delivered the command yet, so give it a moment when woken instead of missing it
+                if woken:
+                    cmd = commands.get(timeout=0.1)
+                    woken = False
+                else:
+                    cmd = commands.get_nowait()
+            except queue.Empty:
+                break
+            if 'runnow' in cmd:
+                runnow_crons.add(cmd['runnow'])
+            elif 'get_timeline' in cmd:
+                timeline_requests.append(cmd['get_timeline'])
+
         # timeline
-        for cmd in commands:
-            if 'get_timeline' in cmd:
-                timeline_start_date = cmd['get_timeline']['start_date']
-                timeline_end_date = cmd['get_timeline']['end_date']
-                timeline_id = cmd['get_timeline']['id']
-                index_name = 'saltpeter*'
-                procname = 'timeline'
-                if use_es:
-                    p_timeline = multiprocessing.Process(target=gettimeline,\
-                            args=(es,timeline_start_date, timeline_end_date, timeline_id, timeline, index_name), name=procname)
-                    p_timeline.start()
-                if use_opensearch:
-                    p_timeline = multiprocessing.Process(target=gettimeline,\
-                            args=(opensearch,timeline_start_date, timeline_end_date, timeline_id, timeline, index_name), name=procname)
-                    p_timeline.start()
-                commands.remove(cmd)
-
-        for name in config['crons'].copy():
+        for timeline_params in timeline_requests:
+            timeline_start_date = timeline_params['start_date']
+            timeline_end_date = timeline_params['end_date']
+            timeline_id = timeline_params['id']
+            index_name = 'saltpeter*'
+            procname = 'timeline'
+            if use_es:
+                p_timeline = multiprocessing.Process(target=gettimeline,\
+                        args=(es,timeline_start_date, timeline_end_date, timeline_id, timeline, index_name), name=procname)
+                p_timeline.start()
+            if use_opensearch:
+                p_timeline = multiprocessing.Process(target=gettimeline,\
+                        args=(opensearch,timeline_start_date, timeline_end_date, timeline_id, timeline, index_name), name=procname)
+                p_timeline.start()
+
+        next_deadline = None
+        for name in crons:
             #determine next run based on the the last time the loop ran, not the current time
-            result = parsecron(name, config['crons'][name], prev)
-            if name not in state:
-                state[name] = {}
+            result = parsecron(name, crons[name], prev)
+            if name not in stateshards:
+                stateshards[name] = manager.dict()
+                state[name] = stateshards[name]
             if name not in statelocks:
                 statelocks[name] = manager.Lock()
             nextrun = prev + timedelta(seconds=result['nextrun'])
-            with statelocks[name]:
-                tmpstate = state[name].copy()
-                tmpstate['next_run'] = nextrun
-                state[name] = tmpstate
+            if nextruns.get(name) != nextrun:
+                nextruns[name] = nextrun
+                stateshards[name].update({ 'next_run': nextrun, 'serial': time.monotonic_ns() })
+                notify()
+            if next_deadline is None or nextrun < next_deadline:
+                next_deadline = nextrun
             #check if there are any start commands
-            runnow = False
-            for cmd in commands:
-                #print('COMMAND: ',cmd)
-                if 'runnow' in cmd:
-                    if cmd['runnow'] == name:
-                        runnow = True
-                        commands.remove(cmd)
+            runnow = name in runnow_crons
+            runnow_crons.discard(name)
             if (result != False and now >= nextrun) or runnow:
                 if name not in last_run or last_run[name] < prev:
                     last_run[name] = now 
@@ -625,29 +924,31 @@ def main():
                     print('Firing %s!' % procname)
 
                     #running[procname] = {'empty': True}
-                    p = multiprocessing.Process(target=run,\
-                            args=(name,config['crons'][name],procname,running, state, commands), name=procname)
+                    p = multiprocessing.Process(target=runjob,\
+                            args=(name,crons[name],procname,running, stateshards[name], killcrons), name=procname)
 
                     processlist[procname] = {}
                     processlist[procname]['cron_name'] = name
-                    processlist[procname]['cron_group'] = config['crons'][name]['group']
+                    processlist[procname]['cron_group'] = crons[name]['group']
 
                     p.start()
         prev = now
-        time.sleep(0.05)
+        #sleep until the earliest next run, at most a second so config changes and
+        #finished jobs are still picked up; api commands wake the loop right away
+        timeout = 1.0
+        if next_deadline is not None:
+            timeout = min(timeout, max((next_deadline - datetime.now(timezone.utc)).total_seconds(), 0))
+        woken = wake.wait(timeout)
+        wake.clear()
 
         #process cleanup
-        processes = multiprocessing.active_children()
-        for entry in list(processlist):
-            found = False
-            for process in processes:
-                if entry == process.name:
-                    found = True
-            if found == False:
-                print('Deleting process %s as it must have finished' % entry)
-                del(processlist[entry])
-                if entry in running:
-                    del(running[entry])
+        active = {process.name for process in multiprocessing.active_children()}
+        for entry in processlist.keys() - active:
+            print('Deleting process %s as it must have finished' % entry)
+            del(processlist[entry])
+            running.pop(entry, None)
+            exclusives.pop(entry, None)
+            notify()
 
 
 if __name__ == "__main__":
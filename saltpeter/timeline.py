@@ -1,6 +1,8 @@
 from elasticsearch import Elasticsearch
 from opensearchpy import OpenSearch
 import argparse
+import json
+import sys
 from datetime import datetime, timedelta
 
 
@@ -21,12 +23,14 @@ use_opensearch = False
 
 if args.elasticsearch != '':
     from elasticsearch import Elasticsearch
+    from elasticsearch.helpers import scan as es_scan
     use_es = True
     global es
     es = Elasticsearch(args.elasticsearch,maxsize=50)
 
 if args.opensearch != '':
     from opensearchpy import OpenSearch
+    from opensearchpy.helpers import scan as opensearch_scan
     use_opensearch = True
     global opensearch
     opensearch = OpenSearch(args.opensearch,maxsize=50,useSSL=False,verify_certs=False)
@@ -46,25 +50,29 @@ query= {
                     "lte": 'now'
                 }
             }
-        }
+        },
+    # only the fields the timeline is built from, not the command output
+    "_source": ["job_name", "job_instance", "@timestamp", "return_code", "msg_type", "machine"]
     }
 
 # Perform the search
-if use_es:
-    result = es.search(index=index_name, body=query)
-if use_opensearch: 
-    result = opensearch.search(index=index_name, body=query, size=10000, scroll='1m')
+# scan drives the scroll for either client and clears the scroll context when done
+# opensearch wins when both are given, as the scroll loop did before
+if use_opensearch:
+    client = opensearch
+    scan = opensearch_scan
+elif use_es:
+    client = es
+    scan = es_scan
+else:
+    sys.exit('No search backend configured, pass -e/--elasticsearch or -o/--opensearch')
 
-
-#print(result)
-
-# Use the scroll API to fetch all documents
-while True:
-    scroll_id = result['_scroll_id']
-    hits = result['hits']['hits']
-    if not hits:
-        break  # Break out of the loop when no more documents are returned
-
-    for hit in hits:
-        print(hit)
-    result = opensearch.scroll(scroll_id=scroll_id, scroll='1m')
+# hits are written as json lines in batches instead of one print per hit
+out = []
+for hit in scan(client, index=index_name, query=query, size=10000, scroll='1m'):
+    out.append(json.dumps(hit))
+    if len(out) >= 1000:
+        sys.stdout.write('\n'.join(out) + '\n')
+        out.clear()
+if out:
+    sys.stdout.write('\n'.join(out) + '\n')
@@ -21,4 +21,8 @@ setup(name='saltpeter',
           'elasticsearch',
           'opensearch-py',
       ],
+      extras_require={
+          'orjson': ['orjson'],
+          'uvloop': ['uvloop'],
+      },
       zip_safe=False)